@@ -18,11 +18,14 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires=">=3.8",
+    python_requires=">=3.9",
     install_requires=[
         "pandas>=1.3.0",
-        "mistralai>=0.0.12",
+        "mistralai>=1.9.10,<2.0.0",
+        "httpx>=0.27.0",
+        "orjson>=3.6.0",
         "tqdm>=4.62.0",
+        "tenacity>=8.2.0",
     ],
     entry_points={
         "console_scripts": [
@@ -0,0 +1,28 @@
+import csv
+
+from zotero_ocr import library_import
+
+
+def test_library_import_multiline_fields_in_large_export(tmp_path):
+    # Zotero exports quote multi-line abstracts and notes; the file must be larger than
+    # one 1 MB parser block so a chunked reader would split rows inside those values
+    library = tmp_path / "library.csv"
+    n_rows = 10_000
+    with open(library, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(["Key", "Title", "Abstract Note", "File Attachments", "Extra"])
+        for i in range(n_rows):
+            writer.writerow([
+                f"K{i}",
+                f"Title {i}",
+                f"First line of abstract {i}\nsecond line of abstract {i} " + "x" * 100,
+                f"/library/storage/K{i}/snapshot.html; /library/storage/K{i}/paper.pdf",
+                "note\nwith a newline",
+            ])
+    assert library.stat().st_size > 1 << 20
+
+    df, paths, path_to_meta = library_import(library)
+
+    assert len(df) == n_rows
+    assert len(paths) == n_rows
+    assert path_to_meta["/library/storage/K9999/paper.pdf"] == ("K9999", "Title 9999")
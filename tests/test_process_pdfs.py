@@ -0,0 +1,48 @@
+import csv
+
+import pytest
+
+import zotero_ocr
+
+
+@pytest.fixture
+def library(tmp_path):
+    library = tmp_path / "library.csv"
+    with open(library, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Key", "Title", "File Attachments"])
+        for key in ["A", "B", "C"]:
+            writer.writerow([key, f"Title {key}", f"/storage/{key}/paper.pdf"])
+    return library
+
+
+@pytest.fixture
+def submitted_paths(monkeypatch):
+    # Replace the API side of the pipeline and record which paths would be sent to it
+    submitted = []
+
+    async def fake_run(paths, *args):
+        submitted.extend(paths)
+
+    monkeypatch.setattr(zotero_ocr, "process_pdfs_async", fake_run)
+    return submitted
+
+
+def test_entries_with_existing_markdown_are_skipped(tmp_path, library, submitted_paths):
+    output = tmp_path / "output"
+    (output / "markdown").mkdir(parents=True)
+    (output / "markdown" / "B.md").write_text("already converted", encoding="utf-8")
+
+    zotero_ocr.process_pdfs(library, output, "api-key")
+
+    assert submitted_paths == ["/storage/A/paper.pdf", "/storage/C/paper.pdf"]
+
+
+def test_force_processes_existing_entries_again(tmp_path, library, submitted_paths):
+    output = tmp_path / "output"
+    (output / "markdown").mkdir(parents=True)
+    (output / "markdown" / "B.md").write_text("already converted", encoding="utf-8")
+
+    zotero_ocr.process_pdfs(library, output, "api-key", force=True)
+
+    assert submitted_paths == ["/storage/A/paper.pdf", "/storage/B/paper.pdf", "/storage/C/paper.pdf"]
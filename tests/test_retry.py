@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from mistralai.models import SDKError
+
+from zotero_ocr import MAX_RETRY_WAIT_SECONDS, is_transient_error, is_unsent_error, retry_wait
+
+
+def sdk_error(status_code, headers=None):
+    request = httpx.Request("POST", "https://api.mistral.ai/v1/ocr")
+    return SDKError("API error occurred", httpx.Response(status_code, headers=headers, request=request))
+
+
+def retry_state(e, attempt_number=1):
+    return SimpleNamespace(outcome=SimpleNamespace(exception=lambda: e), attempt_number=attempt_number)
+
+
+@pytest.mark.parametrize("status_code", [429, 500, 502, 503, 504])
+def test_rate_limits_and_server_errors_are_transient(status_code):
+    assert is_transient_error(sdk_error(status_code))
+
+
+@pytest.mark.parametrize("status_code", [400, 401, 404, 422])
+def test_client_errors_are_not_transient(status_code):
+    assert not is_transient_error(sdk_error(status_code))
+
+
+def test_transport_errors_are_transient():
+    assert is_transient_error(httpx.ReadError("connection reset"))
+    assert is_transient_error(httpx.ConnectError("connection refused"))
+
+
+def test_other_exceptions_are_not_transient():
+    assert not is_transient_error(ValueError("bad pdf"))
+
+
+def test_only_errors_before_the_request_is_sent_are_unsent():
+    assert is_unsent_error(httpx.ConnectError("connection refused"))
+    assert is_unsent_error(sdk_error(429))
+    assert not is_unsent_error(httpx.ReadError("response lost"))
+    assert not is_unsent_error(sdk_error(502))
+
+
+def test_numeric_retry_after_is_honoured():
+    assert retry_wait(retry_state(sdk_error(429, {"retry-after": "5"}))) == 5
+
+
+def test_retry_after_is_clamped_to_the_backoff_ceiling():
+    assert retry_wait(retry_state(sdk_error(429, {"retry-after": "3600"}))) == MAX_RETRY_WAIT_SECONDS
+
+
+@pytest.mark.parametrize("headers", [None, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}])
+def test_missing_or_date_retry_after_falls_back_to_backoff(headers):
+    # First attempt waits the 1s initial backoff plus up to 1s of jitter
+    assert 1 <= retry_wait(retry_state(sdk_error(503, headers))) <= 2
+
+
+def test_backoff_is_capped():
+    assert retry_wait(retry_state(httpx.ReadError("reset"), attempt_number=20)) <= MAX_RETRY_WAIT_SECONDS
@@ -3,20 +3,35 @@ Zotero OCR to Markdown
 
 This is a command line tool that takes in the csv generated from Zotero export function and, for those entries where a PDF is available, it parses it associated into markdown documents and dictionaries containing markdown per page.The outputs are saved using the Zotero entry key as the file name.
 
-This tool uses the Mistral's OCR model via API calls. Average processing speed is between 5 and 10 seconds per PDF.
+This tool uses the Mistral's OCR model via API calls. Average processing speed is between 5 and 10 seconds per PDF, with several PDFs processed concurrently.
 """
 
 import pandas as pd
 import argparse
-import re
-import json
+import asyncio
+import base64
+import uuid
 import sys
 import os
-import re
 
+import httpx
+import orjson
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from mistralai import DocumentURLChunk, Mistral
-from tqdm import tqdm
+from mistralai.models import SDKError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from tqdm.asyncio import tqdm
+
+# Largest pdf sent inline as base64, bigger files are streamed through the files API
+INLINE_PDF_MAX_BYTES = 4 * 1024 * 1024
+INLINE_PDF_URL_PREFIX = "data:application/pdf;base64,"
+BATCH_TIMEOUT_HOURS = 24
+# Urls are signed while the library is still uploading, before the job timeout starts counting
+BATCH_SIGNED_URL_EXPIRY_HOURS = BATCH_TIMEOUT_HOURS + 24
+BATCH_POLL_SECONDS = 30
+BATCH_FINAL_STATUSES = {"SUCCESS", "FAILED", "TIMEOUT_EXCEEDED", "CANCELLED"}
+BATCH_RUN_ID_KEY = "zotero_ocr_run"
 
 
 def library_import(library_directory):
@@ -28,41 +43,133 @@ def library_import(library_directory):
 
     Output: 
         df (Pandas dataframe): cleaned zotero dataframe 
-        paths (list): all the paths to the pdfs 
+        paths (Pandas series): all the paths to the pdfs 
+        path_to_meta (dict): the (Key, Title) of the zotero entry each pdf path belongs to
     """
     try:
-        df = pd.read_csv(library_directory)
-
-        paths = df[df['File Attachments'].notna()]['File Attachments']
-        paths = paths.str.split(';')
-        paths = paths.explode()
-        paths = paths[paths.str.contains('.pdf')]  # select only those referring to pdfs
-        paths = [s[1:] if s.startswith(" ") else s for s in paths]
+        # Only three columns of the export are used, parse just those. The default C engine is kept on purpose:
+        # Zotero writes quoted multi-line notes and abstracts, which the pyarrow engine splits on large files
+        library_columns = ['File Attachments', 'Key', 'Title']
+        df = pd.read_csv(
+            library_directory,
+            usecols=library_columns,
+            dtype={column: 'string' for column in library_columns},
+        )
 
         df = df[df['File Attachments'].notna()]
-        pattern = '|'.join(map(re.escape, paths))
-        df = df[df['File Attachments'].str.contains(pattern, na=False)]
+
+        paths = df['File Attachments'].str.split(';')
+        paths = paths.explode()
+        paths = paths.str.lstrip(' ')
+        paths = paths[paths.str.endswith('.pdf')]  # select only those referring to pdfs
+
+        # The exploded paths keep the index of their row, so the entries with a pdf are a membership test
+        df = df[df.index.isin(paths.index)]
+
+        # Map each pdf path to the first entry referencing it, so lookups are O(1) per file
+        pdf_paths = set(paths)
+        path_to_meta = {}
+        for key, title, attachments in df[['Key', 'Title', 'File Attachments']].itertuples(index=False):
+            for attachment in attachments.split(';'):
+                attachment = attachment.lstrip(' ')
+                if attachment in pdf_paths:
+                    path_to_meta.setdefault(attachment, (key, title))
         
-        return df, paths
+        return df, paths, path_to_meta
     
     except Exception as e:
         print(f"Error importing library: {e}")
-        return pd.DataFrame(), []
+        return pd.DataFrame(), pd.Series(dtype=str), {}
+
 
+def pooled_http_client(concurrency):
+    """
+    Async http client with one keep-alive connection per job, reused across all the API calls of a run
+    """
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(limits=limits, follow_redirects=True)
 
-def mistral_api(api_key):
+
+def mistral_api(api_key, async_client=None):
     """
-    Mistral client setup
+    Mistral client setup, optionally on top of a shared httpx.AsyncClient
     """
     try:
-        client = Mistral(api_key=api_key)
+        client = Mistral(api_key=api_key, async_client=async_client)
         return client
     except Exception as e:
         print(f"Error setting up Mistral client: {e}")
         return None
 
 
-def pdf_ocr(path, client):
+def is_transient_error(e):
+    """
+    Whether a failed API call is worth retrying: rate limits, server errors and dropped connections
+    """
+    if isinstance(e, httpx.TransportError):
+        return True
+    return isinstance(e, SDKError) and (e.status_code == 429 or e.status_code >= 500)
+
+
+MAX_RETRY_WAIT_SECONDS = 60
+exponential_backoff = wait_exponential_jitter(initial=1, max=MAX_RETRY_WAIT_SECONDS)
+
+
+def retry_wait(retry_state):
+    """
+    Wait as long as the Retry-After header asks for, up to the backoff ceiling, falling back to
+    exponential backoff with jitter
+    """
+    e = retry_state.outcome.exception()
+    if isinstance(e, SDKError):
+        try:
+            return min(float(e.raw_response.headers["retry-after"]), MAX_RETRY_WAIT_SECONDS)
+        except (KeyError, ValueError):
+            pass
+    return exponential_backoff(retry_state)
+
+
+def is_unsent_error(e):
+    """
+    Whether a failed API call certainly never reached the server, so even a call that creates something can be retried
+    """
+    if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    return isinstance(e, SDKError) and e.status_code == 429
+
+
+mistral_retry = retry(
+    retry=retry_if_exception(is_transient_error),
+    wait=retry_wait,
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+
+# For calls that are not idempotent: a lost response must not create a second, billed, copy
+mistral_unsent_retry = retry(
+    retry=retry_if_exception(is_unsent_error),
+    wait=retry_wait,
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+
+
+@mistral_retry
+async def upload_pdf_async(client, pdf_file, purpose):
+    """
+    Upload a pdf to Mistral, streaming it from a fresh file handle on every attempt
+    """
+    with open(pdf_file, 'rb') as fh:
+        return await client.files.upload_async(
+            file={
+                "file_name": pdf_file.stem,
+                "content": fh,
+            },
+            purpose=purpose,
+        )
+
+
+async def pdf_ocr_async(path, client):
     """
     Function that uses the Mistral OCR model to parse pdfs into markdown files
 
@@ -72,65 +179,59 @@ def pdf_ocr(path, client):
 
     Output: 
         response_dict (dict): dictionary with the parsed OCR results
-        json_string (str): the same dictionary in string format
-        full_markdown (str): the full markdown string
     """
     try:
         pdf_file = Path(path)
-        
-        uploaded_file = client.files.upload(
-            file={
-                "file_name": pdf_file.stem,
-                "content": pdf_file.read_bytes(),
-            },
-            purpose="ocr",
-        )
-        
-        signed_url = client.files.get_signed_url(file_id=uploaded_file.id, expiry=1)
-        
-        pdf_response = client.ocr.process(
-            document=DocumentURLChunk(document_url=signed_url.url), 
+
+        if pdf_file.stat().st_size <= INLINE_PDF_MAX_BYTES:
+            # Send the pdf inline as a data url: one round trip instead of upload, signed url and OCR.
+            # Built in a single expression so the raw and base64 bytes are freed as soon as they are consumed
+            document_url = INLINE_PDF_URL_PREFIX + base64.b64encode(pdf_file.read_bytes()).decode("ascii")
+        else:
+            # Large pdfs are streamed through the files API rather than held in memory as base64
+            uploaded_file = await upload_pdf_async(client, pdf_file, purpose="ocr")
+            signed_url = await mistral_retry(client.files.get_signed_url_async)(file_id=uploaded_file.id, expiry=1)
+            document_url = signed_url.url
+
+        pdf_response = await mistral_retry(client.ocr.process_async)(
+            document=DocumentURLChunk(document_url=document_url), 
             model="mistral-ocr-latest", 
             include_image_base64=False
         )
         
-        response_dict = json.loads(pdf_response.json())
-        json_string = json.dumps(response_dict, indent=4)
-
-        full_markdown = " ".join(page["markdown"] for page in response_dict["pages"])
+        response_dict = pdf_response.model_dump(mode="json")
         
-        return response_dict, json_string, full_markdown
+        return response_dict
     
     except Exception as e:
         print(f"Error processing PDF {path}: {e}")
         raise
 
 
-def save_file(response_dict, markdown, output_directory, file_name):
+def save_file(response_dict, json_dir, md_dir, file_name):
     """
-    Function that takes the dictionary and markdown and saves it to the disk
+    Function that takes the OCR dictionary and saves it and its markdown to the disk
 
     Input: 
         response_dict (dict): OCR response dictionary
-        markdown (str): Markdown text
-        output_directory (str path): Directory to save outputs
+        json_dir (str path): Existing directory to save the json outputs
+        md_dir (str path): Existing directory to save the markdown outputs
         file_name (str): Name of the file
     """
     try:
-        os.makedirs(os.path.join(output_directory, 'json/'), exist_ok=True)
-        os.makedirs(os.path.join(output_directory, 'markdown/'), exist_ok=True)
-
-        json_dir = os.path.join(output_directory, 'json/')
-        md_dir = os.path.join(output_directory, 'markdown/')
-        
-        json_file = os.path.join(json_dir, f"{file_name}.json")
-        md_file = os.path.join(md_dir, f"{file_name}.md")
+        json_file = f"{json_dir}/{file_name}.json"
+        md_file = f"{md_dir}/{file_name}.md"
         
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(response_dict, f, ensure_ascii=False, indent=2)
-
-        with open(md_file, "w", encoding="utf-8") as f:
-            f.write(markdown)
+        # orjson serialises straight to UTF-8 bytes, written in a single call
+        with open(json_file, 'wb', buffering=1 << 20) as f:
+            f.write(orjson.dumps(response_dict, option=orjson.OPT_INDENT_2))
+
+        # Write the markdown page by page, the full document is never built in memory
+        with open(md_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            for i, page in enumerate(response_dict["pages"]):
+                if i:
+                    f.write(" ")
+                f.write(page["markdown"])
             
     except Exception as e:
         print(f"Error saving files: {e}")
@@ -142,74 +243,271 @@ def write_log(output_directory, processed_files, saved_files, errors):
     Function to write the log file in the output_directory
     """
     try:
-        # Clean the files if they exist
-        file_names = ["processed_files.txt", "saved_files.txt", "failed_files.txt"]
-        for file_name in file_names:
-            file_path = os.path.join(output_directory, file_name)
-            if os.path.exists(file_path):
-                open(file_path, "w").close()
-                
-        # write files
-        with open(os.path.join(output_directory, "processed_files.txt"), "w", encoding='utf-8') as f:
-            for item in processed_files:
-                f.write(f"{item}\n")
-        with open(os.path.join(output_directory, "saved_files.txt"), "w", encoding='utf-8') as f:
-            for item in saved_files:
-                f.write(f"{item}\n")
-        with open(os.path.join(output_directory, "failed_files.txt"), "w", encoding='utf-8') as f:
-            for item in errors:
-                f.write(f"{item}\n")
+        # Opening in 'w' mode already truncates any previous log
+        with open(os.path.join(output_directory, "processed_files.txt"), "w", encoding='utf-8', buffering=1 << 20) as f:
+            f.writelines(f"{item}\n" for item in processed_files)
+        with open(os.path.join(output_directory, "saved_files.txt"), "w", encoding='utf-8', buffering=1 << 20) as f:
+            f.writelines(f"{item}\n" for item in saved_files)
+        with open(os.path.join(output_directory, "failed_files.txt"), "w", encoding='utf-8', buffering=1 << 20) as f:
+            f.writelines(f"{name}\t{msg}\n" for name, msg in errors)
                 
     except Exception as e:
         print(f"Error writing log files: {e}")
 
 
-def process_pdfs(library_path, output_directory, api_key):
+async def run_workers(items, job, concurrency, desc):
+    """
+    Function that runs `job` over all items with a pool of `concurrency` workers fed through a bounded queue,
+    so only a handful of items are in flight at any time however large the library is
+    """
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    with tqdm(total=len(items), desc=desc, unit="file") as progress:
+
+        async def producer():
+            for item in items:
+                await queue.put(item)
+            # One stop signal per worker
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        async def worker():
+            while (item := await queue.get()) is not None:
+                await job(item)
+                progress.update(1)
+
+        await asyncio.gather(producer(), *(worker() for _ in range(concurrency)))
+
+
+async def process_pdf_async(path, path_to_meta, client, json_dir, md_dir, processed_files, saved_files, errors):
+    """
+    Function that runs the OCR and saving steps for a single pdf, recording the outcome in the log lists
+    """
+    title = None
+    try: 
+        file_name, title = path_to_meta[path]
+        
+        response_dict = await pdf_ocr_async(path, client)
+        processed_files.append(title)
+       
+        save_file(response_dict, json_dir, md_dir, file_name)
+        saved_files.append(title)
+        
+    except Exception as e:
+        # Keep only the message, the exception would pin its traceback and the API response in memory
+        errors.append((title if title is not None else path, repr(e)))
+
+
+async def process_pdfs_async(paths, path_to_meta, api_key, json_dir, md_dir, concurrency, processed_files, saved_files, errors):
+    """
+    Function that runs the OCR jobs for all paths concurrently, with at most `concurrency` jobs in flight
+    """
+    async with pooled_http_client(concurrency) as http_client:
+
+        # Set up mistral api client 
+        client = mistral_api(api_key, http_client)
+
+        await run_workers(
+            paths,
+            lambda path: process_pdf_async(path, path_to_meta, client, json_dir, md_dir, processed_files, saved_files, errors),
+            concurrency,
+            desc="Processing PDFs",
+        )
+
+
+async def batch_request_async(path, custom_id, path_to_meta, client, batch_requests, errors):
+    """
+    Function that uploads a single pdf and adds its OCR request to the batch, recording failures in the error log
+    """
+    try:
+        pdf_file = Path(path)
+
+        uploaded_file = await upload_pdf_async(client, pdf_file, purpose="ocr")
+
+        # The job can sit in the queue for hours, so the url has to outlive the whole batch
+        signed_url = await mistral_retry(client.files.get_signed_url_async)(
+            file_id=uploaded_file.id, expiry=BATCH_SIGNED_URL_EXPIRY_HOURS
+        )
+
+        batch_requests.append({
+            "custom_id": custom_id,
+            "body": {
+                "document": {"type": "document_url", "document_url": signed_url.url},
+                "include_image_base64": False,
+            },
+        })
+
+    except Exception as e:
+        print(f"Error uploading PDF {path}: {e}")
+        errors.append((path_to_meta[path][1], repr(e)))
+
+
+@mistral_retry
+async def submit_batch_job_async(client, input_file_id, run_id, submitted_after):
+    """
+    Create the OCR batch job tagged with `run_id`. An earlier attempt may have created the job even though its
+    response was lost, so every attempt first looks for a job with the same tag instead of submitting a second one
+    """
+    jobs = await client.batch.jobs.list_async(
+        metadata={BATCH_RUN_ID_KEY: run_id}, created_after=submitted_after, created_by_me=True
+    )
+    for job in jobs.data or []:
+        if (job.metadata or {}).get(BATCH_RUN_ID_KEY) == run_id:
+            return job
+
+    return await client.batch.jobs.create_async(
+        input_files=[input_file_id],
+        endpoint="/v1/ocr",
+        model="mistral-ocr-latest",
+        metadata={BATCH_RUN_ID_KEY: run_id},
+        timeout_hours=BATCH_TIMEOUT_HOURS,
+    )
+
+
+async def process_batch_async(paths, path_to_meta, api_key, json_dir, md_dir, concurrency, processed_files, saved_files, errors):
+    """
+    Function that runs the OCR of all paths as a single Mistral batch job: the pdfs are uploaded concurrently,
+    submitted as one job, and the results are saved in one pass over the job output
+    """
+    async with pooled_http_client(concurrency) as http_client:
+
+        # Set up mistral api client 
+        client = mistral_api(api_key, http_client)
+
+        # Paths are not valid batch ids and entry keys can repeat, so requests are identified by position
+        id_to_path = {str(i): path for i, path in enumerate(paths)}
+
+        batch_requests = []
+        await run_workers(
+            list(id_to_path.items()),
+            lambda item: batch_request_async(item[1], item[0], path_to_meta, client, batch_requests, errors),
+            concurrency,
+            desc="Uploading PDFs",
+        )
+
+        if not batch_requests:
+            return
+
+        pending_ids = {request["custom_id"] for request in batch_requests}
+        reason = "batch job was not submitted"
+
+        try:
+            batch_file = await mistral_unsent_retry(client.files.upload_async)(
+                file={
+                    "file_name": "zotero_ocr_batch.jsonl",
+                    "content": b"".join(orjson.dumps(request) + b"\n" for request in batch_requests),
+                },
+                purpose="batch",
+            )
+
+            run_id = uuid.uuid4().hex
+            submitted_after = datetime.now(timezone.utc) - timedelta(minutes=5)
+            job = await submit_batch_job_async(client, batch_file.id, run_id, submitted_after)
+
+            # Poll until the job reaches a final state
+            with tqdm(total=len(batch_requests), desc=f"Batch job {job.id}", unit="file") as progress:
+                while job.status not in BATCH_FINAL_STATUSES:
+                    await asyncio.sleep(BATCH_POLL_SECONDS)
+                    job = await mistral_retry(client.batch.jobs.get_async)(job_id=job.id)
+                    progress.update(job.completed_requests - progress.n)
+
+            reason = f"batch job {job.id} ended with status {job.status}"
+
+            # Stream the results and save them one line at a time. Requests that failed inside the job are
+            # written to the error file rather than the output file, so both are read
+            for result_file in (job.output_file, job.error_file):
+                if not result_file:
+                    continue
+
+                response = await mistral_retry(client.files.download_async)(file_id=result_file)
+                try:
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+
+                        result = orjson.loads(line)
+                        pending_ids.discard(result["custom_id"])
+                        file_name, title = path_to_meta[id_to_path[result["custom_id"]]]
+
+                        try:
+                            result_response = result.get("response") or {}
+                            if result.get("error") or result_response.get("status_code") != 200:
+                                raise RuntimeError(f"Batch request failed: {result.get('error') or result_response}")
+
+                            response_dict = result_response["body"]
+                            processed_files.append(title)
+
+                            save_file(response_dict, json_dir, md_dir, file_name)
+                            saved_files.append(title)
+
+                        except Exception as e:
+                            errors.append((title, repr(e)))
+
+                        # Free this result before waiting on the next line, so only one is held at a time
+                        result = result_response = response_dict = None
+                finally:
+                    await response.aclose()
+
+        except Exception as e:
+            print(f"Error running batch job: {e}")
+            reason = f"batch job failed: {e}"
+
+        # Whatever is left never produced a result
+        for custom_id in pending_ids:
+            errors.append((path_to_meta[id_to_path[custom_id]][1], f"No result returned, {reason}"))
+
+
+def process_pdfs(library_path, output_directory, api_key, concurrency=8, batch=False, force=False):
     """
     Main function combining the pipeline.     
     """
     # Import library and derive paths
-    df, paths = library_import(library_path)
-
-    # Set up mistral api client 
-    client = mistral_api(api_key)
+    _, paths, path_to_meta = library_import(library_path)
+
+    # Create the output subdirectories once for the whole run
+    json_dir = os.path.join(output_directory, 'json')
+    md_dir = os.path.join(output_directory, 'markdown')
+    os.makedirs(json_dir, exist_ok=True)
+    os.makedirs(md_dir, exist_ok=True)
+
+    # Skip the entries already converted by a previous run, unless forced to redo them
+    skipped = 0
+    if not force:
+        existing = {entry.name for entry in os.scandir(md_dir)}
+        pending = [f"{path_to_meta[path][0]}.md" not in existing for path in paths]
+        skipped = len(pending) - sum(pending)
+        paths = paths[pending]
 
     # Initialise empty lists for log
     processed_files = []
     saved_files = []
     errors = []
 
-    # Run loop over all existing paths in the Zotero library
-    for path in tqdm(paths, desc="Processing PDFs", unit="file"):
-        try: 
-            row_df = df[df['File Attachments'].str.contains(re.escape(path), na=False)].reset_index(drop=True)
-                
-            file_name = row_df["Key"].values[0] 
-            title = row_df["Title"].values[0]         
-            
-            response_dict, json_string, markdown = pdf_ocr(path, client)
-            processed_files.append(title)
-           
-            save_file(response_dict, markdown, output_directory, file_name)
-            saved_files.append(title)
-            
-        except Exception as e:
-            if 'title' in locals():
-                errors.append(title)
-                errors.append(e)
-            else:
-                errors.append(path)
-                errors.append(e)
+    # Run the OCR jobs over all existing paths in the Zotero library
+    run = process_batch_async if batch else process_pdfs_async
+    asyncio.run(run(paths, path_to_meta, api_key, json_dir, md_dir, concurrency,
+                    processed_files, saved_files, errors))
 
     write_log(output_directory, processed_files, saved_files, errors)
 
     print(f'Successfully processed {len(processed_files)} PDF files from the {library_path} library and '
-          f'saved {len(saved_files)} to {output_directory} with {len(errors)} errors. '
+          f'saved {len(saved_files)} to {output_directory} with {len(errors)} errors '
+          f'({skipped} already processed files skipped). '
           f'See the log files at {output_directory} for more details.')
     
     return True
 
 
+def positive_int(value):
+    """
+    argparse type for options that need a whole number of at least 1
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Convert PDFs to Markdown using Mistral OCR API",
@@ -218,6 +516,11 @@ def main():
     parser.add_argument("-l", "--library", required=True, help="Path to Zotero library CSV file")
     parser.add_argument("-o", "--output", required=True, help="Directory to save output files")
     parser.add_argument("-k", "--api-key", required=True, help="Mistral API key")
+    parser.add_argument("-c", "--concurrency", type=positive_int, default=8, help="Maximum number of PDFs processed concurrently")
+    parser.add_argument("-b", "--batch", action="store_true",
+                        help="Submit all PDFs as a single Mistral batch job: cheaper and not rate limited, but results can take hours")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Process again the entries that already have a markdown file in the output directory")
     
     args = parser.parse_args()
     
@@ -230,7 +533,7 @@ def main():
     os.makedirs(args.output, exist_ok=True)
     
     # Run the processing
-    success = process_pdfs(args.library, args.output, args.api_key)
+    success = process_pdfs(args.library, args.output, args.api_key, args.concurrency, args.batch, args.force)
     
     return 0 if success else 1
 